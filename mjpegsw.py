@@ -5,46 +5,229 @@ Mjpg stream Server with FPS control for LAN webcams.
 """
 
 import argparse
-import os
 import signal
 import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from io import BytesIO
-from threading import Lock
-from time import sleep
+from time import monotonic, sleep
 
 
 import cv2
-from PIL import Image
-from flask import Flask, Response, redirect, send_file, url_for
+import numpy as np
+from flask import Flask, Response, redirect, request, send_file, url_for
+from waitress import serve
+
+try:
+    from turbojpeg import TJPF_BGR, TJSAMP_420, TJSAMP_422, TJSAMP_444, TurboJPEG
+
+    _tj = TurboJPEG()
+    _tj_subsample = {"420": TJSAMP_420, "422": TJSAMP_422, "444": TJSAMP_444}
+    _tj_error = None
+except (ImportError, OSError, RuntimeError) as e:
+    # PyTurboJPEG or libjpeg-turbo 3.0+ is missing, use OpenCV instead
+    _tj = None
+    _tj_error = e
 
 app = Flask(__name__)
-img_lock = Lock()
+
+# Per-frame work is too small for OpenCV's thread pool, frames are encoded in parallel instead
+cv2.setNumThreads(1)
+
+JPEG_QUALITY = 80
+# Chroma subsampling, 4:2:0 is the cheapest to encode and the smallest to send
+JPEG_SUBSAMPLE = "420"
+# Number of encoded frames kept for clients that fall slightly behind
+FRAME_BUFFER_SIZE = 2
+# Frames encoded in parallel, any frame arriving while all are busy is dropped
+ENCODE_WORKERS = 2
+# Server threads never handed to stream viewers, so /snap.jpg keeps answering
+SPARE_SERVER_THREADS = 2
+# Header of every part in the multipart stream, filled in with the JPEG length
+MULTIPART_HEAD = b"--frame\r\nContent-Type: image/jpeg\r\nContent-Length: %d\r\n\r\n"
+
+
+# Per encoder thread output buffer reused by TurboJPEG across frames, only the
+# encoder pool uses it so request threads do not each keep a frame sized buffer
+_encode_buffers = threading.local()
+
+
+def encode_jpeg(frame, quality=JPEG_QUALITY, subsample=JPEG_SUBSAMPLE, reuse_buffer=False):
+    # OpenCV frames are BGR, which TurboJPEG can encode without a color conversion
+    if _tj is not None:
+        jpeg_subsample = _tj_subsample[subsample]
+        if not reuse_buffer:
+            return _tj.encode(
+                frame,
+                quality=quality,
+                pixel_format=TJPF_BGR,
+                jpeg_subsample=jpeg_subsample,
+            )
+        size = _tj.buffer_size(frame, jpeg_subsample)
+        buffer = getattr(_encode_buffers, "buffer", None)
+        if buffer is None or len(buffer) < size:
+            buffer = _encode_buffers.buffer = bytearray(size)
+        _, length = _tj.encode(
+            frame,
+            quality=quality,
+            pixel_format=TJPF_BGR,
+            jpeg_subsample=jpeg_subsample,
+            dst=buffer,
+        )
+        # Clients may still be sending the previous frame, so publish a copy
+        return bytes(memoryview(buffer)[:length])
+    params = [cv2.IMWRITE_JPEG_QUALITY, quality]
+    # Older OpenCV builds always encode with 4:2:0 subsampling
+    if hasattr(cv2, "IMWRITE_JPEG_SAMPLING_FACTOR"):
+        params += [
+            cv2.IMWRITE_JPEG_SAMPLING_FACTOR,
+            getattr(cv2, "IMWRITE_JPEG_SAMPLING_FACTOR_" + subsample),
+        ]
+    ok, _buffer = cv2.imencode(".jpg", np.ascontiguousarray(frame), params)
+    return _buffer.tobytes() if ok else None
+
+
+def decode_jpeg(jpeg):
+    if _tj is not None:
+        return _tj.decode(jpeg, pixel_format=TJPF_BGR)
+    return cv2.imdecode(jpeg, cv2.IMREAD_COLOR)
+
+
+# OpenCV flags for libjpeg's 1/2, 1/4 and 1/8 scaling while decoding
+_cv2_reduced_flags = {
+    1: cv2.IMREAD_COLOR,
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8,
+}
+
+
+def jpeg_width(jpeg):
+    # Read the width from the JPEG header without decoding, 0 if it is not found
+    if _tj is not None:
+        return _tj.decode_header(jpeg)[0]
+    # Walk the marker segments up to the start of frame, which holds the size
+    i = 2
+    while i + 9 <= len(jpeg):
+        if jpeg[i] != 0xFF:
+            return 0
+        marker = jpeg[i + 1]
+        if marker == 0xFF:
+            i += 1
+            continue
+        if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+            return int.from_bytes(jpeg[i + 7 : i + 9], "big")
+        i += 2 + int.from_bytes(jpeg[i + 2 : i + 4], "big")
+    return 0
+
+
+def resize_jpeg(jpeg, width, quality=JPEG_QUALITY, subsample=JPEG_SUBSAMPLE):
+    # Returns None when the JPEG is not wider than width or cannot be decoded
+    try:
+        frame_width = jpeg_width(jpeg)
+    except (OSError, ValueError):
+        # TurboJPEG raises on corrupt or truncated frames
+        return None
+    if not 0 < width < frame_width:
+        return None
+
+    # Let the decoder do most of the downscaling, it skips most of the IDCT work
+    factor = 1
+    while factor < 8 and frame_width // (factor * 2) >= width:
+        factor *= 2
+    if _tj is not None:
+        try:
+            frame = _tj.decode(jpeg, pixel_format=TJPF_BGR, scaling_factor=(1, factor))
+        except (OSError, ValueError):
+            return None
+    else:
+        frame = cv2.imdecode(np.frombuffer(jpeg, np.uint8), _cv2_reduced_flags[factor])
+    if frame is None:
+        return None
+
+    # Resize the rest of the way to the exact width requested
+    height, current_width = frame.shape[:2]
+    if current_width != width:
+        frame = cv2.resize(
+            frame,
+            (width, max(1, round(height * width / current_width))),
+            interpolation=cv2.INTER_AREA,
+        )
+    return encode_jpeg(frame, quality, subsample)
+
 
 class CameraControl:
     def __init__(self):
-        self.capturing = True
-        self.img = None
-        self.lock = Lock()
+        self.capturing = threading.Event()
+        self.capturing.set()
+        self.jpeg_bytes = None
+        # Ring of the last encoded frames, frame_id counts every frame published
+        self.frames = [None] * FRAME_BUFFER_SIZE
+        self.frame_id = 0
+        self.condition = threading.Condition()
+        # Frames are only decoded and encoded while someone is watching
+        self.active_clients = 0
+        self.active_streams = 0
+        self.clients_lock = threading.Lock()
 
     def stop_capturing(self):
-        with self.lock:
-            self.capturing = False
+        self.capturing.clear()
+        # Wake up waiting clients so they notice the camera stopped
+        with self.condition:
+            self.condition.notify_all()
 
     def start_capturing(self):
-        with self.lock:
-            self.capturing = True
-
-    def update_image(self, new_img):
-        with self.lock:
-            self.img = new_img
-
-    def get_image(self):
-        with self.lock:
-            return self.img
+        self.capturing.set()
+
+    def publish(self, jpeg_bytes):
+        # Store the encoded frame and wake up every client waiting for it
+        with self.condition:
+            self.frames[self.frame_id % FRAME_BUFFER_SIZE] = jpeg_bytes
+            self.jpeg_bytes = jpeg_bytes
+            self.frame_id += 1
+            self.condition.notify_all()
+
+    @contextmanager
+    def client(self):
+        with self.clients_lock:
+            self.active_clients += 1
+        try:
+            yield
+        finally:
+            with self.clients_lock:
+                self.active_clients -= 1
+
+    def add_stream(self, max_streams=None):
+        # Reserve a stream slot, returns False when max_streams are already open
+        with self.clients_lock:
+            if max_streams is not None and self.active_streams >= max_streams:
+                return False
+            self.active_streams += 1
+            return True
+
+    def remove_stream(self):
+        with self.clients_lock:
+            self.active_streams -= 1
+
+    def wait_for_frame(self, last_frame_id, timeout=1.0):
+        # Block until a frame newer than last_frame_id is published, returns
+        # (frame_id, jpeg_bytes) or (last_frame_id, None) on timeout or stop.
+        # Clients get the next frame in order while it is still buffered,
+        # when they fall further behind the oldest frames are dropped.
+        with self.condition:
+            self.condition.wait_for(
+                lambda: self.frame_id > last_frame_id or not self.is_capturing(),
+                timeout=timeout,
+            )
+            if self.frame_id <= last_frame_id:
+                return last_frame_id, None
+            index = last_frame_id
+            if self.frame_id - index > FRAME_BUFFER_SIZE:
+                index = self.frame_id - 1
+            return index + 1, self.frames[index % FRAME_BUFFER_SIZE]
 
     def is_capturing(self):
-        with self.lock:
-            return self.capturing
+        return self.capturing.is_set()
 
 
 camera_control = CameraControl()
@@ -60,6 +243,17 @@ def signal_handler_sigint(signal_number, frame):
 signal.signal(signal.SIGINT, signal_handler_sigint)
 
 
+def is_jpeg_buffer(frame):
+    # Undecoded MJPEG frames come back as a flat uint8 buffer with a JPEG SOI marker
+    return (
+        frame.dtype == np.uint8
+        and frame.size > 2
+        and (frame.ndim == 1 or frame.shape[0] == 1)
+        and frame.flat[0] == 0xFF
+        and frame.flat[1] == 0xD8
+    )
+
+
 class CamDaemon(threading.Thread):
     def __init__(
         self,
@@ -70,6 +264,10 @@ class CamDaemon(threading.Thread):
         capture_api,
         fps=30,
         rotate_image=False,
+        mjpeg_passthrough=False,
+        hw_accel=False,
+        jpeg_quality=JPEG_QUALITY,
+        jpeg_subsample=JPEG_SUBSAMPLE,
     ):
         threading.Thread.__init__(self)
         self.camera_control = camera_control
@@ -79,20 +277,94 @@ class CamDaemon(threading.Thread):
         self.rotate_image = rotate_image
         self.capture_api = capture_api
         self.fps = fps
+        self.frame_period = 1 / fps if fps > 0 else 0
+        self.mjpeg_passthrough = mjpeg_passthrough
+        self.hw_accel = hw_accel
+        self.jpeg_quality = jpeg_quality
+        self.jpeg_subsample = jpeg_subsample
+        self.encode_pool = ThreadPoolExecutor(max_workers=ENCODE_WORKERS)
+        self.encode_slots = threading.BoundedSemaphore(ENCODE_WORKERS)
+        self.publish_lock = threading.Lock()
+        self.frame_seq = 0
+        self.published_seq = 0
 
     def run(self):
         self.capture()
 
+    def submit_frame(self, frame):
+        # Drop the frame when every encoder is busy instead of queueing it
+        if not self.encode_slots.acquire(blocking=False):
+            return
+        self.frame_seq += 1
+        future = self.encode_pool.submit(self.process_frame, frame, self.frame_seq)
+        future.add_done_callback(self.frame_done)
+
+    def frame_done(self, future):
+        self.encode_slots.release()
+        if future.exception() is not None:
+            print("Failed to encode image: " + str(future.exception()))
+
+    def publish(self, jpeg, seq):
+        # Encoders can finish out of order, never publish an older frame
+        with self.publish_lock:
+            if seq > self.published_seq:
+                self.published_seq = seq
+                self.camera_control.publish(jpeg)
+
+    def process_frame(self, frame, seq):
+        if self.mjpeg_passthrough:
+            if not self.rotate_image:
+                # Forward the compressed frame from the camera untouched
+                self.publish(frame.tobytes(), seq)
+                return
+            # Rotation needs pixel access, so decode the frame first
+            frame = decode_jpeg(frame)
+            if frame is None:
+                return
+
+        if self.rotate_image:
+            # Reversed view, the pixels are only copied once by the encoder
+            frame = frame[::-1, ::-1]
+
+        # Encode once here so clients only fan out the cached bytes
+        jpeg = encode_jpeg(
+            frame, self.jpeg_quality, self.jpeg_subsample, reuse_buffer=True
+        )
+        if jpeg is not None:
+            self.publish(jpeg, seq)
+
     def capture(self):
         # Initialize the camera with the specified API (e.g., CAP_V4L2)
         if self.capture_api and hasattr(cv2, self.capture_api):
-            capture = cv2.VideoCapture(self.camera, getattr(cv2, self.capture_api))
+            api = getattr(cv2, self.capture_api)
+        else:
+            api = cv2.CAP_ANY
+
+        # Let backends that support it (FFMPEG, GStreamer, MSMF) decode on the GPU
+        if self.hw_accel and hasattr(cv2, "CAP_PROP_HW_ACCELERATION"):
+            capture = cv2.VideoCapture(
+                self.camera,
+                api,
+                [cv2.CAP_PROP_HW_ACCELERATION, cv2.VIDEO_ACCELERATION_ANY],
+            )
         else:
-            capture = cv2.VideoCapture(self.camera)
+            if self.hw_accel:
+                print("Warning: this OpenCV build does not support hardware acceleration")
+            capture = cv2.VideoCapture(self.camera, api)
+
+        # Keep a single kernel buffer so we always get the newest frame, not a queued one
+        try:
+            capture.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+        except Exception as e:
+            print("Warning: Unable to set capture buffer size: " + str(e))
 
         # Set the capture format to MJPEG explicitly
         capture.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*'MJPG'))
 
+        # Ask the backend for the compressed MJPEG buffers instead of decoded pixels
+        if self.mjpeg_passthrough:
+            capture.set(cv2.CAP_PROP_CONVERT_RGB, 0)
+
         # Set the capture width and height
         if self.capture_width:
             capture.set(cv2.CAP_PROP_FRAME_WIDTH, self.capture_width)
@@ -118,37 +390,53 @@ class CamDaemon(threading.Thread):
 
         # Main capture loop
         capture.setExceptionMode(True)
+        next_frame_time = monotonic()
         while self.camera_control.is_capturing():
             try:
-                ret, frame = capture.read()
-                if self.rotate_image:
-                    frame = cv2.rotate(frame, cv2.ROTATE_180)
+                # grab() only dequeues the buffer, frames are decoded when we use them
+                capture.grab()
+                # Keep the device streaming but skip decoding while nobody watches
+                if self.camera_control.active_clients == 0:
+                    continue
+                now = monotonic()
+                if now < next_frame_time:
+                    continue
+                ret, frame = capture.retrieve()
+                if ret and self.mjpeg_passthrough and not is_jpeg_buffer(frame):
+                    # The camera is not sending MJPEG, so the buffer holds raw
+                    # pixels (e.g. YUYV) that can only be used once converted
+                    print(
+                        "Warning: camera frames are not MJPEG, "
+                        "disabling MJPEG passthrough"
+                    )
+                    capture.set(cv2.CAP_PROP_CONVERT_RGB, 1)
+                    self.mjpeg_passthrough = False
+                    continue
                 if ret:
-                    # Update the image in the camera control
-                    self.camera_control.update_image(frame)
-                # Control FPS by calculating frame delay from FPS value
-                sleep(1 / self.fps)
+                    self.submit_frame(frame)
+                # Control FPS by scheduling the next frame we want to keep
+                next_frame_time = max(next_frame_time + self.frame_period, now)
             except Exception as e:
                 print("Error: " + str(e))
                 self.camera_control.stop_capturing()
                 break
 
         # Release the camera resource when done
+        self.encode_pool.shutdown(wait=True)
         capture.release()
 
 
 def create_stream_frame(camera_control):
-    while True:
-        img = camera_control.get_image()
-        if img is not None:
-            try:
-                _, _buffer = cv2.imencode(".jpg", img)
-                frame = _buffer.tobytes()
-                yield (b"--frame\r\nContent-Type: image/jpeg\r\n\r\n" + frame + b"\r\n")
-            except Exception as e:
-                print("Failed to encode image: " + str(e))
+    # Start from the current frame, the cached one can be stale after idling
+    last_frame_id = camera_control.frame_id
+    with camera_control.client():
+        while camera_control.is_capturing():
+            # Wait for the capture thread to publish a frame we have not sent yet
+            last_frame_id, frame = camera_control.wait_for_frame(last_frame_id)
+            if frame is None:
                 continue
-        sleep(0.1)
+            # One chunk per frame, the server copies each chunk it writes anyway
+            yield MULTIPART_HEAD % len(frame) + frame + b"\r\n"
 
 
 @app.route("/")
@@ -158,25 +446,67 @@ def hello_world():
 
 @app.route("/cam.mjpg")
 def video():
-    return Response(
+    # Each viewer holds a server thread while connected, refuse viewers once
+    # only the spare threads are left instead of queueing every other request
+    if not camera_control.add_stream(app.config.get("MAX_STREAMS")):
+        return Response(
+            "Too many stream viewers",
+            status=503,
+            mimetype="text/plain",
+            headers={"Retry-After": "5"},
+        )
+    response = Response(
         create_stream_frame(camera_control),
         mimetype="multipart/x-mixed-replace; boundary=frame",
     )
+    response.call_on_close(camera_control.remove_stream)
+    return response
 
 
 @app.route("/snap.jpg")
 def snap():
     # Check if the camera is capturing and return an empty buffer if not instead of an error
-    if not camera_control.is_capturing() or camera_control.img is None:
+    if not camera_control.is_capturing():
+        return send_file(BytesIO(), download_name="snap.jpg", mimetype="image/jpeg")
+
+    # The capture thread idles without clients, so ask it for a fresh frame
+    with camera_control.client():
+        _, jpeg = camera_control.wait_for_frame(camera_control.frame_id)
+    if jpeg is None:
+        jpeg = camera_control.jpeg_bytes
+
+    # Serve the JPEG already encoded by the capture thread
+    if jpeg is None:
         return send_file(BytesIO(), download_name="snap.jpg", mimetype="image/jpeg")
 
-    img_rgb = cv2.cvtColor(camera_control.img, cv2.COLOR_BGR2RGB)
-    jpeg = Image.fromarray(img_rgb)
-    buffer_file = BytesIO()
-    jpeg.save(buffer_file, "JPEG")
-    buffer_file.seek(0)
+    # Downscale for thumbnails requested with ?w=WIDTH
+    width = request.args.get("w", type=int)
+    if width:
+        thumbnail = resize_jpeg(
+            jpeg,
+            width,
+            app.config.get("JPEG_QUALITY", JPEG_QUALITY),
+            app.config.get("JPEG_SUBSAMPLE", JPEG_SUBSAMPLE),
+        )
+        if thumbnail is not None:
+            jpeg = thumbnail
 
-    return send_file(buffer_file, download_name="snap.jpg", mimetype="image/jpeg")
+    return send_file(BytesIO(jpeg), download_name="snap.jpg", mimetype="image/jpeg")
+
+
+def int_in_range(minimum, maximum=None):
+    # argparse type that rejects integers outside [minimum, maximum]
+    def parse(value):
+        number = int(value)
+        if number < minimum or (maximum is not None and number > maximum):
+            if maximum is None:
+                raise argparse.ArgumentTypeError(f"must be at least {minimum}")
+            raise argparse.ArgumentTypeError(f"must be from {minimum} to {maximum}")
+        return number
+
+    # argparse names the type in its "invalid int value" message
+    parse.__name__ = "int"
+    return parse
 
 
 def handle_args():
@@ -238,6 +568,40 @@ def handle_args():
         type=float,
         default=30,  # Set a default FPS value
     )
+    parser.add_argument(
+        "-m",
+        "--mjpeg_passthrough",
+        help="forward the camera's MJPEG frames without decoding and re-encoding",
+        action="store_true",
+    )
+    parser.add_argument(
+        "-g",
+        "--hw_accel",
+        help="use hardware accelerated decoding when the capture API supports it",
+        action="store_true",
+    )
+    parser.add_argument(
+        "-q",
+        "--jpeg_quality",
+        help="JPEG quality from 1 to 100, default 80",
+        type=int_in_range(1, 100),
+        default=JPEG_QUALITY,
+    )
+    parser.add_argument(
+        "-s",
+        "--jpeg_subsample",
+        help="JPEG chroma subsampling, default 420",
+        type=str,
+        choices=["420", "422", "444"],
+        default=JPEG_SUBSAMPLE,
+    )
+    parser.add_argument(
+        "-t",
+        "--threads",
+        help="http server threads, each stream viewer uses one, default 16",
+        type=int_in_range(1),
+        default=16,
+    )
     params = vars(parser.parse_args())
     return params
 
@@ -254,6 +618,26 @@ def main():
         print("Will use capture API: " + params["capture_api"])
     if params["fps"] > 0:
         print("Will use FPS: " + str(params["fps"]))
+    if params["mjpeg_passthrough"]:
+        print("Will forward MJPEG frames from the camera")
+    if params["hw_accel"]:
+        print("Will use hardware accelerated decoding")
+    if _tj is not None:
+        print("Will encode JPEG with TurboJPEG")
+    else:
+        print("Will encode JPEG with OpenCV, TurboJPEG is unavailable: " + str(_tj_error))
+    print(
+        "Will encode JPEG with quality "
+        + str(params["jpeg_quality"])
+        + " and subsampling "
+        + params["jpeg_subsample"]
+    )
+
+    # Thumbnails from /snap.jpg use the same JPEG settings as the stream
+    app.config["JPEG_QUALITY"] = params["jpeg_quality"]
+    app.config["JPEG_SUBSAMPLE"] = params["jpeg_subsample"]
+    app.config["MAX_STREAMS"] = max(1, params["threads"] - SPARE_SERVER_THREADS)
+    print("Will serve at most " + str(app.config["MAX_STREAMS"]) + " stream viewers")
 
     # Start camera daemon thread
     camera = CamDaemon(
@@ -264,13 +648,22 @@ def main():
         params["capture_api"],
         params["fps"],
         params["rotate"],
+        params["mjpeg_passthrough"],
+        params["hw_accel"],
+        params["jpeg_quality"],
+        params["jpeg_subsample"],
     )
     camera.daemon = True
     camera.start()
 
     try:
-        # Start Flask server
-        app.run(host=params["ipaddress"], port=params["port"], debug=False)
+        # Start the waitress server, each viewer holds one of its worker threads
+        serve(
+            app,
+            host=params["ipaddress"],
+            port=params["port"],
+            threads=params["threads"],
+        )
     except RuntimeError:
         print("Stopping mjpeg server ...")
         camera.join()